@@ -8,6 +8,7 @@ from pfmatch.utils import list_config, load_config
 
 def main(config_file,
          device=None,
+         ddp=None,
          dataset_path=None,
          dataset_size=None,
          lr=None,
@@ -28,6 +29,9 @@ def main(config_file,
 
     device : str
         cpu/gpu/mps (if software/hardware supported)
+
+    ddp : bool
+        If True, train with DistributedDataParallel (launch one process per GPU with torchrun)
         
     dataset_path : str
         Path to the dataset. If None, use the one in the config file. Note:
@@ -95,6 +99,7 @@ def main(config_file,
 
     cfg_update = dict()
     if device: cfg_update['type']=device
+    if ddp is not None: cfg_update['ddp']=ddp
     device_cfg = cfg.get('device',dict())
     device_cfg.update(cfg_update)
     cfg['device'] = device_cfg
@@ -102,8 +107,14 @@ def main(config_file,
     if schedule_lr is not None and not schedule_lr and cfg['train'].get('lr_scheduler'):
         cfg['train'].pop('lr_scheduler')
 
+    if cfg['device'].get('ddp'):
+        torch.distributed.init_process_group('nccl')
+
     sopt = SOptimizer(cfg)
     sopt.train()
+
+    if cfg['device'].get('ddp'):
+        torch.distributed.destroy_process_group()
     
 if __name__ == '__main__':
     torch.set_float32_matmul_precision('medium')
@@ -1,5 +1,7 @@
 import torch
 
+from pfmatch.utils import poisson_nll_stirling_term
+
 class PoissonMatchLoss(torch.nn.Module):
     """
     Poisson NLL Loss for gradient-based optimization model
@@ -10,8 +12,21 @@ class PoissonMatchLoss(torch.nn.Module):
             full=True,
             reduction="none")
 
-    def forward(self, input, target, weight=1., axis=-1):
+    @staticmethod
+    def stirling_term(target):
+        """
+        Target-only Stirling term of the full Poisson NLL (see `pfmatch.utils.poisson_nll_stirling_term`).
+        It can be computed once per batch (e.g. in `ToyMCDataset.collate_fn`) and passed to
+        `forward` to avoid recomputing it at every step.
+        """
+        return poisson_nll_stirling_term(target)
+
+    def forward(self, input, target, weight=1., axis=-1, target_stirling=None):
         H = torch.clamp(input, min=0.01)
         O = torch.clamp(target, min=0.01)
-        loss = self.poisson_nll(H, O) - torch.log(H) / 2
+        if target_stirling is None:
+            loss = self.poisson_nll(H, O) - torch.log(H) / 2
+        else:
+            # same as torch.nn.functional.poisson_nll_loss(log_input=False, full=True)
+            loss = H - O * torch.log(H + self.poisson_nll.eps) + target_stirling - torch.log(H) / 2
         return torch.mean(weight*loss, axis=axis)
@@ -1,13 +1,46 @@
+from functools import partial
+
 import numpy as np
 import torch
+from torch.utils.checkpoint import checkpoint_sequential
 from slar.nets import SirenVis
 
+
+def _checkpointed_forward(net, segments, x):
+    """Sequential forward that recomputes the activations of each segment during backward"""
+    if not torch.is_grad_enabled():
+        return torch.nn.Sequential.forward(net, x)
+    return checkpoint_sequential(net, segments, x, use_reentrant=False)
+
 class SirenTrack(SirenVis):
     """Siren class implementation for p.e. reconstruction of an entire track in LArTPCs"""
 
     def __init__(self, cfg : dict, ckpt_file : str = None):
         # this works with siren's that are already trained with voxel data!
         super().__init__(cfg, ckpt_file)
+
+    def set_gradient_checkpointing(self, segments=True):
+        """Recompute the SIREN layer activations during backward instead of storing them.
+
+        The SIREN layer stack (the largest `torch.nn.Sequential` in the model) is split into
+        `segments` checkpointed segments; True checkpoints every layer, and False/0 disables.
+        Only the forward of the stack is replaced, so the state_dict is unchanged.
+
+        Parameters
+        ----------
+        segments : bool or int
+            number of checkpointed segments (True for one per layer).
+        """
+        stacks = [m for m in self.modules() if isinstance(m, torch.nn.Sequential)]
+        if not stacks:
+            raise RuntimeError('[SirenTrack] no SIREN layer stack found for gradient checkpointing')
+        net = max(stacks, key=len)
+
+        net.__dict__.pop('forward', None)
+        if segments is True:
+            segments = len(net)
+        if segments:
+            net.forward = partial(_checkpointed_forward, net, min(int(segments), len(net)))
     
     def _inv_xform_vis(self, vis):
         """SirenVis._inv_xform_vis()"""
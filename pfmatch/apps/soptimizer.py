@@ -1,18 +1,81 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from time import time
 
 import torch
 import yaml
 from slar.optimizers import get_lr, optimizer_factory
 from pfmatch.utils import CSVLogger, get_device, load_toymc_config
-from torch.utils.data import DataLoader, random_split
+from torch import distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, DistributedSampler, random_split
 from tqdm import tqdm
 
 from pfmatch.algorithms import PoissonMatchLoss, SirenTrack
 from pfmatch.io import ToyMCDataset
 
 
+class _Prefetcher:
+    """Iterates over a DataLoader while copying the next batch to the device.
+
+    On CUDA, the host-to-device copy of batch i+1 is issued on a side stream
+    so that it overlaps with the compute on batch i. The copies go into two
+    sets of device buffers that are allocated once and reused (resized in
+    place for the ragged qpt_v), which keeps the caching allocator out of the
+    loop and the input addresses stable. On other devices batches are simply
+    moved to the device.
+
+    Note that on CUDA the yielded tensors *are* those buffers: they are resized and
+    overwritten in place two batches later, so clone anything (e.g. a batch or the
+    target spectrum) that has to outlive the next iteration.
+    """
+
+    def __init__(self, loader, device):
+        self._loader = loader
+        self._device = device
+        self._stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self._buffers = [dict(), dict()]
+        self._slot = 0
+
+    def __len__(self):
+        return len(self._loader)
+
+    def _preload(self, it):
+        batch = next(it, None)
+        if batch is None:
+            return None
+        if self._stream is None:
+            return {k: v.to(self._device) for k, v in batch.items()}
+
+        buf = self._buffers[self._slot]
+        self._slot ^= 1
+        current = torch.cuda.current_stream(self._device)
+        with torch.cuda.stream(self._stream):
+            # do not overwrite the buffers before the compute that last read them is done
+            self._stream.wait_stream(current)
+            for k, v in batch.items():
+                if k not in buf:
+                    buf[k] = torch.empty_like(v, device=self._device)
+                buf[k].resize_(v.shape).copy_(v, non_blocking=True)
+        return dict(buf)
+
+    def __iter__(self):
+        it = iter(self._loader)
+        batch = self._preload(it)
+        while batch is not None:
+            if self._stream is not None:
+                torch.cuda.current_stream(self._device).wait_stream(self._stream)
+            next_batch = self._preload(it)
+            yield batch
+            batch = next_batch
+
+
 class SOptimizer:
+
+    # columns recorded in the training log
+    LOG_COLUMNS = ('iter','epoch','loss','val_loss','lr','ttrain','twait')
+
     def __init__(self, cfg:dict):
         """Train the SirenVis model using track data.
         
@@ -30,42 +93,130 @@ class SOptimizer:
         - `slar.utils.CSVLogger`: a logger for the training process (cfg['logger'])
         - `torch.optim.Optimizer`: an optimizer for the SirenVis model (cfg['train'])
         
+        On CUDA, the model can be wrapped with `torch.compile` by setting cfg['train']['compile']
+        to true, or to a dict of `torch.compile` keyword arguments (default `mode='default'`).
+        Setting cfg['train']['amp'] runs training and validation under autocast (bf16, or fp16
+        with a GradScaler); note the reduced precision of the sine arguments in SIREN layers.
+        Setting cfg['train']['gradient_checkpointing'] (true for every layer, or a number of
+        segments) trades recomputation in the backward pass for lower activation memory.
+        With cfg['train']['grad_accum_steps'] = N, gradients from N batches are accumulated
+        per optimizer step; `iteration` counts optimizer steps.
+        
+        With cfg['device']['ddp'] true, the model is wrapped in `DistributedDataParallel` (one
+        process per GPU, e.g. launched with torchrun; the process group must be initialized
+        beforehand, as done in `train-siren-toymc.py`). Each rank trains on a shard of the
+        dataset, and only rank 0 writes logs and checkpoints.
+        
         The main method is `train()`, which runs the training loop. See the example notebook
         `Train_SOptimizer.ipynb` for an example configuration and usage.
         """
 
-        if cfg.get('device'):
+        if cfg.get('device',dict()).get('type'):
             self._device = get_device(cfg['device']['type'])
         else:
             self._device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+        # distributed data parallel: one process per GPU
+        self._ddp = cfg.get('device',dict()).get('ddp', False)
+        self._rank = 0
+        if self._ddp:
+            if not dist.is_initialized():
+                raise RuntimeError('[SOptimizer] ddp requires an initialized torch.distributed process group')
+            local_rank = int(os.environ.get('LOCAL_RANK', 0))
+            torch.cuda.set_device(local_rank)
+            self._device = torch.device('cuda', local_rank)
+            self._rank = dist.get_rank()
+            print(f'[SOptimizer] DDP rank {self._rank}/{dist.get_world_size()} on',self._device)
         
         # model & loss function
         self._model = SirenTrack(cfg).to(self._device)
+        if cfg['train'].get('gradient_checkpointing'):
+            self._model.set_gradient_checkpointing(cfg['train']['gradient_checkpointing'])
+        if self._ddp:
+            # the graph is identical every step, so DDP can skip unused-parameter searches
+            self._model = DDP(self._model, device_ids=[self._device.index],
+                              bucket_cap_mb=25, gradient_as_bucket_view=True, static_graph=True)
+        compile_cfg = cfg['train'].get('compile', False)
+        if compile_cfg and self._device.type == 'cuda':
+            # no CUDA graphs by default: qpt_v is ragged, so 'reduce-overhead' would record a
+            # new graph for nearly every batch (opt in through the dict if shapes are fixed)
+            compile_args = dict(mode='default', dynamic=None)
+            if isinstance(compile_cfg, dict):
+                compile_args.update(compile_cfg)
+            print('[SOptimizer] compiling the model with',compile_args)
+            self._model = torch.compile(self._model, **compile_args)
         self._criterion = PoissonMatchLoss().to(self._device)
 
         # init and split dataset
         dataset = ToyMCDataset(cfg)
         val_split = cfg['train'].get('validation_split', 0.1)
         print('[SOptimizer] Using validation split',val_split)
-        generator = torch.Generator().manual_seed(cfg['train'].get('seed', 0))
-        train, val = random_split(dataset, [1-val_split, val_split], generator=generator)
+        # independent generators: the split is unchanged for a given seed, and the
+        # val batch order does not depend on how much of the train loader was consumed
+        seed = cfg['train'].get('seed', 0)
+        gen_split = torch.Generator().manual_seed(seed)
+        gen_train = torch.Generator().manual_seed(seed+1)
+        gen_val = torch.Generator().manual_seed(seed+2)
+        # defaults go into a copy so the saved train_cfg.yaml keeps the user's loader options
+        loader_cfg = dict(cfg['data']['loader'])
+        if self._device.type == 'cuda':
+            # page-locked host memory lets the H2D copies in step() run asynchronously
+            loader_cfg['pin_memory'] = True
+        # split the default worker count between the DDP processes sharing the node
+        local_ranks = int(os.environ.get('LOCAL_WORLD_SIZE', dist.get_world_size())) if self._ddp else 1
+        loader_cfg.setdefault('num_workers', max((os.cpu_count() or 1)//(2*local_ranks), 2))
+        if loader_cfg['num_workers'] > 0:
+            # keep workers alive across epochs and queue more batches ahead of the GPU
+            loader_cfg.setdefault('persistent_workers', True)
+            loader_cfg.setdefault('prefetch_factor', 4)
+        train, val = random_split(dataset, [1-val_split, val_split], generator=gen_split)
+        # validation runs only periodically, so its workers need not stay resident
+        train_loader_cfg = dict(loader_cfg)
+        val_loader_cfg = dict(loader_cfg, persistent_workers=False)
+        if self._ddp:
+            # each rank iterates over its own shard (shuffled by the sampler)
+            train_loader_cfg.update(shuffle=False, sampler=DistributedSampler(train, shuffle=True, seed=seed+1))
+            val_loader_cfg.update(shuffle=False, sampler=DistributedSampler(val, shuffle=False))
         self._dataloader = {
-            'train': DataLoader(train, collate_fn=dataset.collate_fn, generator=generator, **cfg['data']['loader']),
-            'val': DataLoader(val, collate_fn=dataset.collate_fn, generator=generator, **cfg['data']['loader'])
+            'train': DataLoader(train, collate_fn=dataset.collate_fn, generator=gen_train, **train_loader_cfg),
+            'val': DataLoader(val, collate_fn=dataset.collate_fn, generator=gen_val, **val_loader_cfg)
         }   
-        self._opt, epoch = optimizer_factory(self._model.parameters(), cfg)
+        self._prefetcher = {k: _Prefetcher(v, self._device) for k, v in self._dataloader.items()}
+        self._train_batches = len(self._dataloader['train'])
+        self._train_examples = len(self._dataloader['train'].dataset)
+        opt_cfg = cfg
+        optim = cfg['train'].get('optimizer', dict())
+        if self._device.type == 'cuda' and optim.get('name') in ('Adam', 'AdamW'):
+            # update all parameters in one fused kernel instead of one launch per tensor;
+            # applied to a copy so the saved train_cfg.yaml stays device independent
+            optim = dict(optim, parameters=dict(optim.get('parameters') or dict()))
+            optim['parameters'].setdefault('fused', True)
+            opt_cfg = dict(cfg, train=dict(cfg['train'], optimizer=optim))
+        self._opt, epoch = optimizer_factory(self._model.parameters(), opt_cfg)
+
+        # mixed precision (CUDA only, opt-in): bf16 if supported, else fp16 with loss scaling
+        self._amp = cfg['train'].get('amp', False) and self._device.type == 'cuda'
+        self._amp_dtype = torch.float32
+        if self._amp:
+            self._amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            print('[SOptimizer] using mixed precision with',self._amp_dtype)
+        self._scaler = torch.amp.GradScaler('cuda', enabled=self._amp_dtype == torch.float16)
         
         # resume training?
         self.iteration, self.epoch = 0, 0
         if cfg['train'].get('resume') and cfg['model']['ckpt_file']:
-            import re
             # file name goes as iteration-{}-epoch-{}.ckpt
-            iteration, epoch = re.findall(r'iteration-(\d+)-epoch-(\d+).ckpt', cfg['model']['ckpt_file'])[0]
-            self.iteration = int(iteration)
-            self.epoch = int(epoch)
-            print('[SOptimizer] Resuming training at iteration',iteration,'epoch',epoch)
+            base = os.path.basename(cfg['model']['ckpt_file'])
+            parts = base[:-len('.ckpt')].split('-')
+            self.iteration = int(parts[1])
+            self.epoch = int(parts[3])
+            print('[SOptimizer] Resuming training at iteration',self.iteration,'epoch',self.epoch)
         
         self._logger = CSVLogger(cfg)
+        # logging (incl. pe spectrum analysis) runs on a background thread from pinned host copies
+        self._log_executor = None
+        self._log_future = None
+        self._log_buf = dict()
         
         # learning rate scheduler
         lrs = cfg['train'].get('lr_scheduler',dict())
@@ -85,10 +236,16 @@ class SOptimizer:
         train_cfg = cfg.get('train',dict())
         self.epoch_max = train_cfg.get('max_epochs',int(1e20))
         self.iteration_max = train_cfg.get('max_iterations',int(1e20))
-        self.validate_every_iterations = train_cfg.get('validate_every_iterations',len(self.dataloader['train']))
+        self.grad_accum_steps = max(train_cfg.get('grad_accum_steps',1),1)
+        self.validate_every_iterations = train_cfg.get('validate_every_iterations',
+                                                       max(self._train_batches//self.grad_accum_steps,1))
         self.save_every_iterations = train_cfg.get('save_every_iterations',-1)
         self.save_every_epochs = train_cfg.get('save_every_epochs',-1)
 
+    @property
+    def rank(self):
+        """Process rank (0 unless training with DDP)"""
+        return self._rank
 
     @property
     def model(self):
@@ -128,14 +285,14 @@ class SOptimizer:
         ----------
         input : dict
             a dictionary containing a batch of qpt_v, pe_v, and q_sizes, as returned by
-            `ToyMCDataset.__getitem__`.
-        """
+            `ToyMCDataset.collate_fn`, already moved to `self.device` (see `_Prefetcher`).
+            On CUDA its tensors are reused buffers, and so is the returned target.
 
-        input['qpt_v'] = input['qpt_v'].to(self.device)
-        input['pe_v'] = input['pe_v'].to(self.device)
-        input['q_sizes'] = input['q_sizes'].to(self.device)
-        input['weights'] = input['weights'].to(self.device)
-        input['charge_csum'] = input['charge_csum'].to(self.device)
+        Returns
+        -------
+        tuple
+            target p.e. spectrum, predicted p.e. spectrum, and the loss.
+        """
 
         # run model
         out = self.model(input)
@@ -144,7 +301,7 @@ class SOptimizer:
         weights = input['weights']
         
         # compute loss
-        loss = self.criterion(pred, target, weights)
+        loss = self.criterion(pred, target, weights, target_stirling=input.get('pe_v_stirling'))
 
         return target, pred, loss
     
@@ -154,40 +311,68 @@ class SOptimizer:
         """
         twait = time()
         stop_training = False            
-        val_loss = torch.nan
+        val_loss = float('nan')
+        micro_iteration = 0
     
         # epoch loop
         while self.iteration < self.iteration_max and \
               self.epoch < self.epoch_max:  
+
+            if self._ddp:
+                self.dataloader['train'].sampler.set_epoch(self.epoch)
                   
             # iteration loop (batch loop)
-            for batch in tqdm(self.dataloader['train'], desc='Epoch %-3d'%self.epoch, unit='batch'):
-                self.iteration += 1
+            # throttle progress bar redraws, which are not negligible for fast steps
+            for batch in tqdm(self._prefetcher['train'], desc='Epoch %-3d'%self.epoch, unit='batch',
+                              mininterval=0.5, miniters=50, smoothing=0.1, disable=self.rank > 0):
                 twait = time() - twait
 
+                # accumulate gradients over grad_accum_steps batches per optimizer step;
+                # timings and loss are summed over the window and logged once per step
+                if micro_iteration % self.grad_accum_steps == 0:
+                    ttrain, twait_window, loss_window = 0., 0., 0.
+                twait_window += twait
+                micro_iteration += 1
+                accumulate = micro_iteration % self.grad_accum_steps
+
                 # step the model                    
-                ttrain = time()
-                target, pred, loss = self.step(batch)
-                # backprop
-                self.opt.zero_grad()
-                loss.backward()
-                self.opt.step()
-                ttrain = time() - ttrain
+                tstart = time()
+                # with DDP, gradients are only all-reduced on the last micro-batch; DDP decides
+                # this in the forward pass, so both forward and backward run under no_sync
+                with self.model.no_sync() if self._ddp and accumulate else nullcontext():
+                    with torch.autocast(device_type=self.device.type, dtype=self._amp_dtype, enabled=self._amp):
+                        target, pred, loss = self.step(batch)
+                    # backprop (the scaler is a no-op unless training in fp16)
+                    self._scaler.scale(loss / self.grad_accum_steps).backward()
+                # stays on the device: no sync added per micro-batch
+                loss_window = loss_window + loss.detach().mean()
+
+                if accumulate:
+                    ttrain += time() - tstart
+                    twait = time()
+                    continue
+
+                self.iteration += 1
+                self._scaler.step(self.opt)
+                self._scaler.update()
+                self.opt.zero_grad(set_to_none=True)
+                ttrain += time() - tstart
                 
-                # log training parameters
-                cols = ['iter','epoch','loss','val_loss', 'lr', 'ttrain','twait']
-                vals = [self.iteration, self.epoch, loss.item(), val_loss, get_lr(self.opt), ttrain, twait]
-                self.logger.record(cols, vals)
+                # log training parameters (loss averaged over the accumulation window)
+                vals = [self.iteration, self.epoch, loss_window / self.grad_accum_steps, val_loss,
+                        get_lr(self.opt), ttrain, twait_window]
 
                 twait = time()
 
-                # step the logger (pe spectrum)
-                self.logger.step(self.iteration, target, pred)
+                # record and step the logger (pe spectrum) in the background
+                self.log(vals, target, pred)
                 
                 # validate periodically after iterations (default 1 epoch)
                 if self.validate_every_iterations > 0 and \
                     self.iteration % self.validate_every_iterations == 0:
-                    val_loss = self.validate()
+                    # keep val_loss a python float so neither the scheduler nor the
+                    # logger touches device memory in the following iterations
+                    val_loss = float(self.validate())
 
                     if self.scheduler: self.scheduler.step(val_loss)
                 
@@ -208,27 +393,137 @@ class SOptimizer:
             
             # save model params periodically after epochs
             if (self.save_every_epochs*self.epoch) > 0 and self.epoch % self.save_every_epochs == 0:
-                self.save(count=self.iteration/len(self.dataloader['train'].dataset))
+                self.save(count=self.iteration/self._train_examples)
             
         print('[SOptimizer] Stopped training at iteration',self.iteration,'epochs',self.epoch)
-        self.logger.write()
-        self.logger.close()
+        self.wait_log()
+        if self._log_executor is not None:
+            self._log_executor.shutdown(wait=True)
+            self._log_executor = None
+        if self.rank == 0:
+            self.logger.write()
+            self.logger.close()
+
 
+    def log(self, vals, target, pred):
+        """Records the training parameters and steps the logger on a background thread.
+
+        Tensor values (e.g. the loss) and, on iterations that are logged, `target` and
+        `pred` are copied asynchronously to pinned host buffers. The background job waits
+        for the copies, so the training loop never blocks on a device-to-host sync.
+
+        Parameters
+        ----------
+        vals : list
+            values for the columns in `SOptimizer.LOG_COLUMNS` (python scalars or tensors,
+            which are logged as their mean).
+        target : torch.Tensor
+            true p.e. spectrum of the batch.
+        pred : torch.Tensor
+            predicted p.e. spectrum of the batch.
+        """
+        if self.rank > 0:
+            return
+
+        # one pending job at a time keeps the logger state and the host buffers consistent
+        self.wait_log()
+
+        vals = list(vals)
+        for i, v in enumerate(vals):
+            if torch.is_tensor(v):
+                vals[i] = self._to_log_scalar(i, v)
+
+        if self.iteration % self.logger.log_every_nsteps == 0:
+            target = self._to_log_buffer('target', target)
+            pred = self._to_log_buffer('pred', pred)
+        else:
+            target, pred = None, None
+
+        ready = None
+        if self.device.type == 'cuda':
+            ready = torch.cuda.Event()
+            ready.record()
+
+        if self._log_executor is None:
+            self._log_executor = ThreadPoolExecutor(max_workers=1)
+        self._log_future = self._log_executor.submit(self._log_job, self.iteration, vals, target, pred, ready)
+
+    def wait_log(self):
+        """Waits for the pending background logging job (re-raising its exception, if any)."""
+        if self._log_future is not None:
+            self._log_future.result()
+            self._log_future = None
+
+    def _log_job(self, iteration, vals, target, pred, ready):
+        if ready is not None:
+            ready.synchronize()
+        vals = [v.item() if torch.is_tensor(v) else v for v in vals]
+        self.logger.record(self.LOG_COLUMNS, vals)
+        self.logger.step(iteration, target, pred)
+
+    def _to_log_buffer(self, key, x):
+        x = x.detach()
+        if self.device.type != 'cuda':
+            return x.cpu()
+        buf = self._log_buf.get(key)
+        if buf is None or buf.shape != x.shape or buf.dtype != x.dtype:
+            buf = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+            self._log_buf[key] = buf
+        buf.copy_(x, non_blocking=True)
+        return buf
+
+    def _to_log_scalar(self, i, x):
+        # one pinned slot per log column, read back by the logging job; reduce
+        # non-scalar values (e.g. a per-track loss) so they fit the 0-d slot
+        x = x.detach()
+        if x.dim() > 0:
+            x = x.mean()
+        if self.device.type != 'cuda':
+            return x.cpu()
+        buf = self._log_buf.get('vals')
+        if buf is None:
+            buf = torch.empty(len(self.LOG_COLUMNS), pin_memory=True)
+            self._log_buf['vals'] = buf
+        buf[i].copy_(x, non_blocking=True)
+        return buf[i]
 
     def save(self, count=None):
-        """Saves the model parameters to a checkpoint file."""
+        """Saves the model parameters to a checkpoint file (on rank 0 only)."""
+        if self.rank > 0:
+            return
         if count is None:
-            count = self.iteration/len(self.dataloader['train'].dataset)
+            count = self.iteration/self._train_examples
 
+        # the log directory is created by the first logger write
+        self.wait_log()
         filename = os.path.join(self.logger.logdir,'iteration-%06d-epoch-%04d.ckpt')
-        self.model.save_state(filename % (self.iteration, self.epoch), self.opt, count)
+        model = getattr(self.model, '_orig_mod', self.model)
+        if isinstance(model, DDP):
+            model = model.module
+        model.save_state(filename % (self.iteration, self.epoch), self.opt, count)
 
     def validate(self):
-        """Validates the model using the validation dataset."""
-
-        with torch.no_grad():
-            val_loss = 0
-            for batch in self.dataloader['val']:
-                val_loss += self.step(batch)[-1]
-            val_loss /= len(self.dataloader['val'])
-        return val_loss
\ No newline at end of file
+        """Validates the model using the validation dataset.
+
+        Returns
+        -------
+        float
+            the mean loss over the validation batches.
+        """
+
+        self.model.eval()
+        with torch.inference_mode(), torch.autocast(device_type=self.device.type, dtype=self._amp_dtype, enabled=self._amp):
+            # accumulate on the device and synchronize only once at the end
+            val_loss = torch.zeros((), device=self.device)
+            n = 0
+            for batch in self._prefetcher['val']:
+                # the criterion reduces over PMTs only, giving one loss per track
+                val_loss += self.step(batch)[-1].detach().mean()
+                n += 1
+            if self._ddp:
+                # average over the validation shards of all ranks
+                stats = torch.stack([val_loss, torch.tensor(float(n), device=self.device)])
+                dist.all_reduce(stats)
+                val_loss, n = stats[0], stats[1].item()
+        self.model.train()
+        return (val_loss / max(n, 1)).item()
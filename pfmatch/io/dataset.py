@@ -7,7 +7,7 @@ import torch
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
-from pfmatch.utils import load_detector_config
+from pfmatch.utils import load_detector_config, poisson_nll_stirling_term
 
 
 class ToyMCDataset(Dataset):
@@ -232,4 +232,6 @@ class ToyMCDataset(Dataset):
         output['q_sizes'] = torch.as_tensor([data['q_sizes'] for data in batch], dtype=torch.int32)
         output['charge_csum'] = torch.concatenate([torch.tensor([0], dtype=torch.int32), torch.cumsum(output['q_sizes'], dim=0)], dim=0)
         output['weights'] = torch.as_tensor([data['weights'] for data in batch], dtype=torch.float32)
+        # target-only part of the loss, computed here once instead of at every training step
+        output['pe_v_stirling'] = poisson_nll_stirling_term(output['pe_v'])
         return output
@@ -114,6 +114,30 @@ def partial_flash_time_integral(cfg:dict):
 
     return partial(flash_time_integral, **cfg['FlashTimeIntegral'])
 
+def poisson_nll_stirling_term(target, min_target=0.01):
+    """
+    Stirling approximation term of the full Poisson NLL, which depends on the target only.
+
+    This mirrors the `full=True` branch of `torch.nn.functional.poisson_nll_loss`
+    (torch/nn/functional.py): `target*log(target) - target + 0.5*log(2*pi*target)`,
+    masked to zero where `target <= 1`. The target is clamped as in `PoissonMatchLoss`.
+
+    Parameters
+    ----------
+    target : torch.Tensor
+        observed p.e. spectrum.
+    min_target : float
+        lower clamp applied to the target (as in `PoissonMatchLoss`).
+
+    Returns
+    -------
+    torch.Tensor
+        the Stirling term with the same shape as target.
+    """
+    O = torch.clamp(target, min=min_target)
+    term = O * torch.log(O) - O + 0.5 * torch.log(2 * np.pi * O)
+    return term.masked_fill(O <= 1, 0)
+
 def generate_unbounded_tracks(N, boundary, extension_factor=0.2, rng=np.random):
     """
     Generates N tracks within a given 3D boundary with an extension factor to improve edge coverage.
@@ -236,6 +260,10 @@ class CSVLogger:
     @property
     def logdir(self):
         return self._logdir
+
+    @property
+    def log_every_nsteps(self):
+        return self._log_every_nsteps
         
     def get_logdir(self, dir_name):
         '''
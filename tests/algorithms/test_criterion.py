@@ -20,4 +20,17 @@ def test_PoissonMatchLoss(num_pmt, randn):
     assert isinstance(loss, torch.Tensor), 'expected tensor'
     assert loss.shape == (), 'expected scalar'
 
-    loss.backward()
\ No newline at end of file
+    loss.backward()
+
+def test_PoissonMatchLoss_stirling(num_pmt, randn):
+    loss_fn = PoissonMatchLoss()
+    pred = torch.pow(-8*randn(size=(3,num_pmt)), 10)
+    target = torch.pow(-8*randn(size=(3,num_pmt)), 10)
+    weight = randn(size=(3,num_pmt)).abs()
+
+    loss = loss_fn(pred, target, weight)
+    loss_cached = loss_fn(pred, target, weight,
+                          target_stirling=PoissonMatchLoss.stirling_term(target))
+    assert loss_cached.shape == (3,), 'expected one loss per row'
+    assert torch.allclose(loss, loss_cached), \
+        'expected the precomputed Stirling term to reproduce the full Poisson NLL'
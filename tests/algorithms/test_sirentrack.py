@@ -0,0 +1,59 @@
+import os
+
+import pytest
+import torch
+import yaml
+
+from pfmatch.algorithms import SirenTrack
+from tests.fixtures import GLOBAL_SEED, num_pmt, test_data_dir, torch_rng
+
+
+@pytest.fixture
+def siren_track(test_data_dir, num_pmt):
+    cfg = f'''
+    model:
+        network:
+            in_features: 3
+            hidden_features: 512
+            hidden_layers: 5
+            out_features: {num_pmt}
+        ckpt_file: "{os.path.join(test_data_dir, 'siren.ckpt')}"
+    '''
+    return SirenTrack(yaml.safe_load(cfg))
+
+
+@pytest.fixture
+def batch(torch_rng):
+    q_sizes = torch.tensor([3, 5, 2], dtype=torch.int32)
+    qpt_v = torch.rand(size=(int(q_sizes.sum()), 4), generator=torch_rng)*2 - 1
+    qpt_v[:, 3] = 20_000*qpt_v[:, 3].abs()
+    charge_csum = torch.concatenate([torch.tensor([0], dtype=torch.int32), torch.cumsum(q_sizes, dim=0)])
+    return dict(qpt_v=qpt_v, q_sizes=q_sizes, charge_csum=charge_csum)
+
+
+def grads(model, batch):
+    model.zero_grad(set_to_none=True)
+    pe_v = model(batch)['pe_v']
+    pe_v.sum().backward()
+    return pe_v.detach(), {k: p.grad.clone() for k, p in model.named_parameters() if p.grad is not None}
+
+
+@pytest.mark.parametrize('segments', [True, 2])
+def test_SirenTrack_gradient_checkpointing(siren_track, batch, segments):
+    pe_ref, grad_ref = grads(siren_track, batch)
+    state_keys = set(siren_track.state_dict().keys())
+
+    siren_track.set_gradient_checkpointing(segments)
+    pe_ckpt, grad_ckpt = grads(siren_track, batch)
+
+    assert set(siren_track.state_dict().keys()) == state_keys, 'expected an unchanged state_dict'
+    assert torch.allclose(pe_ref, pe_ckpt), 'expected the same prediction with checkpointing'
+    assert grad_ref.keys() == grad_ckpt.keys(), 'expected gradients for the same parameters'
+    for k in grad_ref:
+        assert torch.allclose(grad_ref[k], grad_ckpt[k], rtol=1e-4, atol=1e-6), \
+            f'expected the same gradient for {k} with checkpointing'
+
+    # disabling restores the plain forward
+    siren_track.set_gradient_checkpointing(False)
+    assert 'forward' not in max((m for m in siren_track.modules() if isinstance(m, torch.nn.Sequential)),
+                                key=len).__dict__
@@ -1 +1,109 @@
-pass
\ No newline at end of file
+import csv
+import glob
+import os
+
+import h5py
+import numpy as np
+import pytest
+import torch
+
+from pfmatch.apps.soptimizer import SOptimizer, _Prefetcher
+from tests.fixtures import GLOBAL_SEED, num_pmt, rng, test_data_dir, torch_rng
+
+
+@pytest.fixture
+def ragged_batches(torch_rng, num_pmt):
+    batches = []
+    for n in [5, 9, 3, 9, 1]:
+        q_sizes = torch.tensor([n], dtype=torch.int32)
+        batches.append({
+            'qpt_v': torch.rand(size=(n, 4), generator=torch_rng),
+            'pe_v': torch.rand(size=(1, num_pmt), generator=torch_rng),
+            'q_sizes': q_sizes,
+            'charge_csum': torch.tensor([0, n], dtype=torch.int32),
+        })
+    return batches
+
+
+def check_prefetcher(batches, device):
+    prefetcher = _Prefetcher(batches, device)
+    assert len(prefetcher) == len(batches), 'expected the length of the loader'
+
+    # iterate twice: the prefetcher is reused across epochs
+    for _ in range(2):
+        count = 0
+        for expected, batch in zip(batches, prefetcher):
+            assert batch.keys() == expected.keys(), 'expected the same keys'
+            for k, v in batch.items():
+                assert v.device.type == device.type, f'expected {k} on {device}'
+                assert v.shape == expected[k].shape, f'expected the shape of {k} to follow the batch'
+                assert torch.equal(v.cpu(), expected[k]), f'expected the values of {k}'
+            count += 1
+        assert count == len(batches), 'expected every batch once per epoch'
+
+
+def test_Prefetcher_cpu(ragged_batches):
+    check_prefetcher(ragged_batches, torch.device('cpu'))
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='requires CUDA')
+def test_Prefetcher_cuda(ragged_batches):
+    check_prefetcher(ragged_batches, torch.device('cuda:0'))
+
+
+@pytest.fixture
+def toymc_cfg(tmp_path, rng, num_pmt, test_data_dir):
+    n_tracks = 8
+    sizes = rng.integers(2, 10, size=n_tracks)
+    fname = str(tmp_path / 'toymc.h5')
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('qpt_v_normed', data=rng.uniform(-1, 1, size=(sizes.sum(), 4)).astype(np.float32))
+        f.create_dataset('num_qpt_v', data=sizes.astype(np.int16))
+        f.create_dataset('pe_v', data=rng.uniform(0, 1000, size=(n_tracks, num_pmt)).astype(np.float32))
+
+    return {
+        'device': {'type': 'cpu'},
+        'data': {
+            'dataset': {'filepath': fname},
+            'loader': {'batch_size': 1, 'shuffle': True, 'num_workers': 0},
+        },
+        'logger': {'dir_name': str(tmp_path / 'logs'), 'file_name': 'log.csv', 'log_every_nsteps': 1},
+        'model': {
+            'network': {'in_features': 3, 'hidden_features': 512, 'hidden_layers': 5, 'out_features': num_pmt},
+            'ckpt_file': os.path.join(test_data_dir, 'siren.ckpt'),
+        },
+        'train': {
+            'validation_split': 0.25,
+            'seed': 123,
+            'max_iterations': 4,
+            'grad_accum_steps': 2,
+            'validate_every_iterations': 2,
+            'save_every_iterations': 2,
+            'optimizer': {'name': 'Adam', 'parameters': {'lr': 1e-6}},
+        },
+    }
+
+
+def test_SOptimizer_train(toymc_cfg):
+    loader_cfg = dict(toymc_cfg['data']['loader'])
+    sopt = SOptimizer(toymc_cfg)
+    assert toymc_cfg['data']['loader'] == loader_cfg, 'expected the loader config to be left untouched'
+
+    val_loss = sopt.validate()
+    assert isinstance(val_loss, float) and np.isfinite(val_loss), 'expected a finite float validation loss'
+
+    # 6 training tracks / 2 accumulated batches = 3 iterations per epoch
+    sopt.train()
+    assert sopt.iteration == 4, 'expected to stop at max_iterations'
+    assert sopt.epoch == 1, 'expected to cross an epoch boundary'
+
+    with open(sopt.logger.logfile) as f:
+        rows = list(csv.DictReader(f))
+    # the final write at the end of train() repeats the last row
+    assert sorted({int(float(r['iter'])) for r in rows}) == [1, 2, 3, 4], 'expected a log row per optimizer step'
+    assert all(np.isfinite(float(r['loss'])) for r in rows), 'expected finite training losses'
+    assert np.isfinite(float(rows[-1]['val_loss'])), 'expected the validation loss to be logged'
+
+    ckpts = sorted(os.path.basename(f) for f in glob.glob(os.path.join(sopt.logger.logdir, '*.ckpt')))
+    assert ckpts == ['iteration-000002-epoch-0000.ckpt', 'iteration-000004-epoch-0001.ckpt'], \
+        'expected a checkpoint every 2 iterations'